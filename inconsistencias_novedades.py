@@ -8,15 +8,16 @@ basándose en el ID del tramite y el número de resolución.
 HERRAMIENTAS UTILIZADAS:
 - PostgreSQL: Base de datos utilizada para consultar los registros.
 - psycopg2: Librería para conectarse y ejecutar consultas en PostgreSQL.
-- xml.etree.ElementTree: Módulo para procesar y extraer datos de archivos XML.
+- lxml: Librería para procesar el archivo XML de forma incremental (iterparse), sin cargar todo el árbol en memoria.
 - decouple: Librería para manejar credenciales y configuración sensible desde un archivo `.env`.
 
 FUNCIONAMIENTO:
 1. Conexión a la base de datos PostgreSQL.
-2. Consulta de registros desde una tabla específica, según criterios de municipio, fechas, y campo "número de resolución".
-3. Extracción de datos relevantes del archivo XML.
-4. Comparación de los datos de la base de datos con los del archivo XML para identificar registros faltantes.
-5. Generación de un archivo de log con el flujo detallado de ejecución, resultados, y una consulta SQL para analizar los registros faltantes directamente en la base de datos.
+2. Extracción de datos relevantes del archivo XML.
+3. Carga de los números de resolución del XML en una tabla temporal y consulta, desde una tabla específica y según criterios de municipio, fechas,
+   y campo "número de resolución", de los registros que no están en el XML (LEFT JOIN resuelto por PostgreSQL).
+   Si no es posible crear la tabla temporal, se consultan los registros y la comparación se hace en Python.
+4. Generación de un archivo de log con el flujo detallado de ejecución, resultados, y una consulta SQL para analizar los registros faltantes directamente en la base de datos.
 
 PARAMETROS/INPUTS:
 1. Credenciales de la base de datos PostgreSQL (host, nombre de la base de datos, usuario, contraseña, puerto).
@@ -33,21 +34,44 @@ OUTPUTS:
    - Identificación de registros faltantes (cantidad total y los primeros 10).
    - Consulta SQL generada para ejecutar en pgAdmin y analizar los registros faltantes.
    - Finalización del script.
+
+ÍNDICE RECOMENDADO:
+Las consultas filtran por municipio (town) y rango de fechas (estado_actual_fecha_inicio), en ese orden, y no ordenan el resultado.
+Con el siguiente índice de cobertura PostgreSQL puede resolverlas con un recorrido solo de índice (index-only scan):
+   CREATE INDEX ON data.tramite (town, estado_actual_fecha_inicio) INCLUDE (id, resolution_number) WHERE resolution_number IS NOT NULL;
 """
+import csv
+import io
+from itertools import compress, islice
+from operator import itemgetter, not_
+
 import psycopg2
-import xml.etree.ElementTree as ET
+from psycopg2 import sql
+from lxml import etree
 from decouple import config
 
 log_file = "log.txt"
+log_fh = None  # Archivo de log abierto en main() durante toda la ejecución
+
+# Expresiones XPath compiladas una sola vez para extraer los campos de cada <mutacion_rectificacion>.
+# smart_strings=False devuelve str simples, sin referencia al elemento, para que record.clear() libere la memoria
+xpath_radicado = etree.XPath('string(radicado)', smart_strings=False)
+xpath_resolucion = etree.XPath('string(resolucion)', smart_strings=False)
 
 def log_message(message):
     """
-    Escribe un mensaje en el archivo de log y lo imprime en la consola.
+    Escribe un mensaje en el archivo de log (con buffer, se vuelca al cerrar) y lo imprime en la consola.
     """
-    with open(log_file, "a") as log_filee:
-        log_filee.write(message + "\n")
+    log_fh.write(message)
+    log_fh.write("\n")
     print(message)
 
+def table_identifier(table_name):
+    """
+    Construye el identificador SQL (esquema.tabla) a partir del nombre de la tabla, escapado por psycopg2
+    """
+    return sql.Identifier(*table_name.split('.'))
+
 def connect_to_db():
     """
     Función que sirve para conectar con la Base de Datos de PostgreSQL
@@ -66,134 +90,197 @@ def connect_to_db():
         log_message(f"Error al conectar con la Base de Datos PostgreSQL: {e}")
         return None
     
-def get_table_data(conn, table_name, town, date_i, date_f):
+def get_missing_records(conn, table_name, town, date_i, date_f, xml_values):
     """
-    Obtiene los datos de id, núnero de resolución de una tabla especifica (tramite) de la DB PostgreSQL, para un municipio y rango de fechas descrito
+    Obtiene los datos de id, núnero de resolución de una tabla especifica (tramite) de la DB PostgreSQL, para un municipio y rango de fechas descrito,
+    y conserva solo los registros cuyo número de resolución no está en el conjunto de valores del XML.
+    El contraste se hace a medida que llegan las filas, sin construir un diccionario con toda la tabla
     """
+    cursor = None
     try:
-        cursor = conn.cursor()
-        query = f"""
+        # Cursor del lado del servidor: las filas llegan por lotes en lugar de cargarse todas con fetchall()
+        cursor = conn.cursor(name='tramite_stream')
+        cursor.itersize = 10000
+        query = sql.SQL("""
         SELECT id, resolution_number 
-        FROM {table_name} 
-        WHERE town = '{town}'
-        AND estado_actual_fecha_inicio BETWEEN '{date_i}' AND '{date_f}'
+        FROM {table} 
+        WHERE town = %s
+        AND estado_actual_fecha_inicio BETWEEN %s AND %s
         AND resolution_number IS NOT NULL
-        ORDER BY resolution_number ASC
-        """
-        cursor.execute(query)
-        result = cursor.fetchall()
-        log_message(f"Consulta realizada a la tabla '{table_name}' con {len(result)} registros obtenidos.")
-        if result:
+        """).format(table=table_identifier(table_name))
+        cursor.execute(query, (town, date_i, date_f))
+        missing_records = {}  # Diccionario {id tramite: num resolución}
+        total = 0
+        is_found = xml_values.__contains__
+        # Se procesan lotes completos: compress/map filtran las filas cuya resolución no está en el XML sin ejecutar un ciclo en Python por fila.
+        # Todo se lee con fetchmany: en un cursor con nombre cada llamada ejecuta un FETCH nuevo y descartaría filas ya leídas por iteración
+        rows = cursor.fetchmany(cursor.itersize)
+        first_rows = rows[:10]  # Se conservan para el log sin recorrer dos veces el resultado
+        while rows:
+            total += len(rows)
+            missing_records.update(compress(rows, map(not_, map(is_found, map(itemgetter(1), rows)))))
+            rows = cursor.fetchmany(cursor.itersize)
+        log_message(f"Consulta realizada a la tabla '{table_name}' con {total} registros obtenidos.")
+        if first_rows:
             log_message("Primeros 10 registros de la tabla:")
-            for row in result[:10]:
+            for row in first_rows:
                 log_message(f"ID TRAMITE: {row[0]}, NUMERO DE RESOLUCION: {row[1]}")
-        return {row[0]: row[1] for row in result}  # Diccionario {id tramite: num resolución}
+        log_missing_records(missing_records)
+        return missing_records
     except Exception as e:
         log_message(f"Error consultando la tabla {table_name}: {e}")
         return {}
+    finally:
+        if cursor is not None:
+            cursor.close()
     
-def parse_xml(file_path):
+def parse_xml_values(file_path):
     """
-    Lee y procesa el archivo XML. Extrae un diccionario radicado: resolucion
+    Lee y procesa el archivo XML. Extrae el conjunto de números de resolución, que es lo único necesario para el contraste con la DB
     """
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
         # Extrae los datos relevantes, ajustable según la estructura de XML
-        xml_data = {}
+        xml_values = set()
+        first_records = []  # Primeros 10 pares radicado: resolucion, solo para el log
+        total = 0
 
-        # Buscar todos los elementos <mutacion_rectificacion>
-        for record in root.findall('./mutacion_rectificacion'):
-            record_id = record.find('radicado').text  # ID obtenido de <radicado>
-            record_value = record.find('resolucion').text  # Valor de <resolucion>
+        # Recorrer incrementalmente los elementos <mutacion_rectificacion> sin construir el árbol completo
+        for _, record in etree.iterparse(file_path, events=('end',), tag='mutacion_rectificacion'):
+            record_id = xpath_radicado(record)  # ID obtenido de <radicado>
+            record_value = xpath_resolucion(record)  # Valor de <resolucion>
             if record_id and record_value:  # Solo agregar si ambos están presentes
-                xml_data[record_id] = record_value
+                xml_values.add(record_value)
+                total += 1
+                if len(first_records) < 10:
+                    first_records.append((record_id, record_value))
+
+            # Liberar el elemento procesado y sus hermanos anteriores
+            record.clear()
+            while record.getprevious() is not None:
+                del record.getparent()[0]
 
         # Mensaje de seguimiento
-        log_message(f"Archivo XML '{file_path}' procesado con {len(xml_data)} registros obtenidos.")
+        log_message(
+            f"Archivo XML '{file_path}' procesado con {total} registros obtenidos "
+            f"({len(xml_values)} números de resolución distintos)."
+        )
         
         # Mostrar los 10 primeros registros        
-        if xml_data:
+        if first_records:
             log_message("Primeros 10 registros del XML:")
-            for idx, (record_id, record_value) in enumerate(xml_data.items()):
-                if idx >= 10:
-                    break
+            for record_id, record_value in first_records:
                 log_message(f"ID: {record_id}, Resolución: {record_value}")
 
-        return xml_data
+        return frozenset(xml_values)
     except Exception as e:
         log_message(f"Error procesando el archivo XML '{file_path}': {e}")
-        return {}
+        return frozenset()
     
-def find_missing_records(db_data, xml_data):
+def log_missing_records(missing_records):
     """
-    Encuentra los registros presentes en la base de datos pero faltantes en el XML
-    basándose en los valores de 'resolution_number' y 'record_value'. Haciendo contraste de registros del diccionario extraido de la DB
-    VS el diccionario extraido del XML
+    Registra en el log la cantidad de registros faltantes y los primeros 10
     """
-    # Convertir los valores de xml_data a un conjunto para comparaciones eficientes
-    xml_values = set(xml_data.values())
-    
-    # Encontrar los registros en db_data cuyos valores no están en xml_data
-    missing_records = {key: value for key, value in db_data.items() if value not in xml_values}
-    
-    # Logging de los resultados
     log_message(f"Se encontraron {len(missing_records)} registros faltantes.")
     if missing_records:
         log_message("Primeros 10 registros faltantes:")
-        for idx, (record_id, record_value) in enumerate(missing_records.items()):
-            if idx >= 10:
-                break
+        for record_id, record_value in islice(missing_records.items(), 10):
             log_message(f"ID: {record_id}, Resolución: {record_value}")
-    
-    return missing_records
+
+def get_missing_records_db(conn, table_name, town, date_i, date_f, xml_values):
+    """
+    Obtiene directamente de la DB los registros de la tabla (tramite) cuyo número de resolución no está en el XML.
+    Los valores del XML se cargan en una tabla temporal y PostgreSQL resuelve la diferencia con un LEFT JOIN, devolviendo solo los faltantes.
+    Retorna None si no es posible (p. ej. usuario sin permiso para crear tablas temporales o réplica de solo lectura)
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("CREATE TEMP TABLE xml_res (resolution_number text PRIMARY KEY) ON COMMIT DROP")
+        # Carga masiva con COPY; los valores ya vienen sin duplicados, como exige la llave primaria de la tabla temporal.
+        # El formato CSV se encarga de escapar comas, comillas o saltos de línea presentes en los valores
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows((value,) for value in xml_values)
+        buffer.seek(0)
+        cursor.copy_expert("COPY xml_res (resolution_number) FROM STDIN WITH (FORMAT csv)", buffer)
+        query = sql.SQL("""
+        SELECT t.id, t.resolution_number
+        FROM {table} t
+        LEFT JOIN xml_res x ON x.resolution_number = t.resolution_number
+        WHERE t.town = %s
+        AND t.estado_actual_fecha_inicio BETWEEN %s AND %s
+        AND t.resolution_number IS NOT NULL
+        AND x.resolution_number IS NULL
+        """).format(table=table_identifier(table_name))
+        cursor.execute(query, (town, date_i, date_f))
+        missing_records = dict(cursor)  # Diccionario {id tramite: num resolución}, construido en una sola llamada sin lista intermedia
+        log_message(f"Consulta de registros faltantes realizada en la DB sobre la tabla '{table_name}'.")
+        log_missing_records(missing_records)
+        return missing_records
+    except Exception as e:
+        log_message(f"Error consultando los registros faltantes en la DB: {e}")
+        return None
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.rollback()  # Descarta la tabla temporal y deja la conexión lista para otras consultas
 
 def main():
-    # Sobrescribir el archivo de log al inicio
-    with open(log_file, "w") as log_filee:
-        log_filee.write("Inicio del script.\n")
-
-    db_connection = connect_to_db()
-    if not db_connection:
-        log_message("Conexión fallida. Terminando el script.")
-        return
-    
+    global log_fh
+    # Sobrescribir el archivo de log al inicio y mantenerlo abierto hasta el final del script
+    log_fh = open(log_file, "w", buffering=1 << 16)
     try:
-        # PARAMETROS PARA CONSULTA DE DATOS EN LA DB DE POSTGRESQL
-        db_table_name = 'data.tramite' # CAMBIAR NOMBRE DE LA TABLA, DE SER NECESARIO
-        db_town ='25168'
-        db_date_i = '2024-11-01'
-        db_date_f = '2024-12-12'
-        db_data = get_table_data(db_connection, db_table_name, db_town, db_date_i, db_date_f)
-
-        # PROCESAR EL ARCHIVO XML
-        xml_file_path =  r"C:\ACC\Novedades_Catastrales\INSUMOS\XML\Registro_novedades_25168.xml"  # Ruta del archivo XML
-        xml_data = parse_xml(xml_file_path)
-
-        # IDENTIFICAR LOS REGISTROS FALTANTES (PRESENTES EN LA DB Y FALTANTES EN EL XML)
-        missing_records = find_missing_records(db_data, xml_data)
-
-        log_message("Proceso completado. Los registros faltantes se han identificado: ")
-        for record_id, record_value in missing_records.items():
-            log_message(f"ID TRAMITE: {record_id}, NUMERO RESOLUCION: {record_value}")
+        log_fh.write("Inicio del script.\n")
+
+        db_connection = connect_to_db()
+        if not db_connection:
+            log_message("Conexión fallida. Terminando el script.")
+            return
+    
+        try:
+            # PARAMETROS PARA CONSULTA DE DATOS EN LA DB DE POSTGRESQL
+            db_table_name = 'data.tramite' # CAMBIAR NOMBRE DE LA TABLA, DE SER NECESARIO
+            db_town ='25168'
+            db_date_i = '2024-11-01'
+            db_date_f = '2024-12-12'
+
+            # PROCESAR EL ARCHIVO XML
+            xml_file_path =  r"C:\ACC\Novedades_Catastrales\INSUMOS\XML\Registro_novedades_25168.xml"  # Ruta del archivo XML
+            xml_values = parse_xml_values(xml_file_path)
+
+            # IDENTIFICAR LOS REGISTROS FALTANTES (PRESENTES EN LA DB Y FALTANTES EN EL XML)
+            missing_records = get_missing_records_db(db_connection, db_table_name, db_town, db_date_i, db_date_f, xml_values)
+            if missing_records is None:
+                log_message("No fue posible calcular los faltantes en la DB. Se realiza la comparación en Python.")
+                missing_records = get_missing_records(db_connection, db_table_name, db_town, db_date_i, db_date_f, xml_values)
+
+            log_message("Proceso completado. Los registros faltantes se han identificado: ")
+            for record_id, record_value in missing_records.items():
+                log_message(f"ID TRAMITE: {record_id}, NUMERO RESOLUCION: {record_value}")
     
-        # Sentencia SQL final para copiar y pegar en la DB
-        if missing_records:
-            sql_query = f"""
-            SELECT * 
-            FROM {db_table_name}
-            WHERE town = '{db_town}'
-              AND estado_actual_fecha_inicio BETWEEN '{db_date_i}' AND '{db_date_f}'
-              AND resolution_number IN ({', '.join(f"'{value}'" for value in missing_records.values())})
-            ORDER BY resolution_date ASC;
-            """
-            log_message("Consulta SQL para insertar en la DB:")
-            log_message(sql_query)
+            # Sentencia SQL final para copiar y pegar en la DB
+            if missing_records:
+                query = sql.SQL("""
+                SELECT * 
+                FROM {table}
+                WHERE town = %s
+                  AND estado_actual_fecha_inicio BETWEEN %s AND %s
+                  AND resolution_number = ANY(%s)
+                ORDER BY resolution_date ASC;
+                """).format(table=table_identifier(db_table_name))
+                # Se compone la sentencia con los valores escapados por psycopg2 para poder copiarla en pgAdmin
+                with db_connection.cursor() as cursor:
+                    sql_query = cursor.mogrify(
+                        query, (db_town, db_date_i, db_date_f, list(missing_records.values()))
+                    ).decode()
+                log_message("Consulta SQL para insertar en la DB:")
+                log_message(sql_query)
                 
+        finally:
+            db_connection.close()
+            log_message("Conexión con la Base de Datos cerrada.")
+        log_message("Fin del script.")
     finally:
-        db_connection.close()
-        log_message("Conexión con la Base de Datos cerrada.")
-    log_message("Fin del script.")
+        log_fh.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file